@@ -1,16 +1,14 @@
 __version__ = '0.0.1'
 
 import logging
+import os
+
+from .conf import config
+from .log import setup_logging
 
 logger = logging.getLogger("cpms")
-logging.basicConfig(
-    filename="logs.log", 
-    encoding='utf-8', 
-    level=logging.DEBUG,
-    format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+if os.environ.get("CPMS_AUTOLOG"):
+    setup_logging()
 
 
-from .conf import config
 from .util import mkdir, rmtree, pretty_print_cmdline
\ No newline at end of file
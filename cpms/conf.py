@@ -28,6 +28,38 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import shutil
+
+
+# Minimum free space for the shared memory tmpfs to host the sandboxes.
+TMPFS_MIN_FREE = 2 * 1024 * 1024 * 1024  # 2 GiB
+
+
+def tmpfs_sandbox_dir():
+    """Return a directory to keep the sandboxes in memory, if possible.
+
+    This is /dev/shm when it is a mounted, writable filesystem with
+    enough free space that allows executing files (the compiled
+    programs run from there), and /tmp otherwise. It is not the default
+    for config.sandbox_dir: tmpfs pages are charged to the memory
+    cgroup of the process writing them and can't be reclaimed without
+    swap, so with cgroups the output files of a solution count against
+    its memory limit, which can change its verdict.
+
+    return (str): the path of the directory.
+
+    """
+    shm = "/dev/shm"
+    try:
+        if os.path.ismount(shm) and os.access(shm, os.W_OK | os.X_OK) \
+                and not os.statvfs(shm).f_flag & os.ST_NOEXEC \
+                and shutil.disk_usage(shm).free > TMPFS_MIN_FREE:
+            return shm
+    except OSError:
+        pass
+    return "/tmp"
+
+
 class Config:
     """This class will contain the configuration for CMS. This needs
     to be populated at the initilization stage. This is loaded by
@@ -44,6 +76,10 @@ class Config:
 
         # System-wide
         self.temp_dir = "/tmp"
+        # Directory for the sandboxes, kept apart from temp_dir, which
+        # also hosts the (unbounded) local file cache. Can be set to
+        # tmpfs_sandbox_dir() to keep them in memory.
+        self.sandbox_dir = "/tmp"
         self.file_log_debug = False
         self.stream_log_detailed = False
 
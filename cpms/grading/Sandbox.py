@@ -27,22 +27,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import errno
 import io
+import itertools
 import logging
+import mmap
 import os
 import stat
 import tempfile
 import select
 from abc import ABCMeta, abstractmethod
 from functools import wraps, partial
+from types import MappingProxyType
 
 import gevent
 from gevent import subprocess
+from gevent.threadpool import ThreadPool
 
 from cpms import config, pretty_print_cmdline, rmtree
 
 logger = logging.getLogger(__name__)
 
+# Bytes to megabytes conversion factor.
+_MB = 1.0 / (1024 * 1024)
+
 def with_log(func):
     """Decorator for presuming that the logs are present.
 
@@ -58,6 +66,20 @@ def with_log(func):
 
     return newfunc
 
+def join_prefix(prefix, path):
+    """Join a path to a directory prefix ending with a separator.
+
+    Same as os.path.join(prefix, path), absolute paths included, but
+    a plain concatenation for the usual relative paths.
+
+    prefix (str): a directory path ending with a separator.
+    path (str): a path, relative to prefix or absolute.
+
+    return (str): the joined path.
+
+    """
+    return path if path.startswith(os.sep) else prefix + path
+
 def wait_without_std(procs):
     """Wait for the conclusion of the processes in the list, avoiding
     starving for input and output.
@@ -103,6 +125,78 @@ def wait_without_std(procs):
 
     return [process.wait() for process in procs]
 
+# Maximum number of bytes copied by a single in-kernel copy syscall,
+# between two cooperative yields.
+FASTCOPY_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MiB
+
+# Errors meaning that an in-kernel copy syscall is not supported for the
+# given file descriptors (e.g., across filesystems, on old kernels).
+_FASTCOPY_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                errno.ENOTSUP, errno.EOPNOTSUPP,
+                                errno.ENOTSOCK}
+
+def fastcopy(source_fobj, destination_fobj):
+    """Copy all content from one file object to another, in kernel space.
+
+    The content never reaches user space: copy_file_range() is tried
+    first, then sendfile(). The copy starts at the current positions of
+    the two file objects, which must be unbuffered or have empty
+    buffers. Be cooperative with other greenlets by yielding often.
+
+    source_fobj (fileobj): a binary file object open for reading.
+    destination_fobj (fileobj): a binary file object open for writing.
+
+    return (bool): True if the content has been copied, False if the
+        file objects don't support an in-kernel copy (in which case
+        nothing has been copied).
+
+    raise (OSError): if the copy fails after some content has been
+        copied, including when it stops short of the end of the file.
+
+    """
+    try:
+        src_fd = source_fobj.fileno()
+        dst_fd = destination_fobj.fileno()
+    except io.UnsupportedOperation:
+        return False
+
+    copy_functions = []
+    if hasattr(os, "copy_file_range"):
+        copy_functions.append(os.copy_file_range)
+    if hasattr(os, "sendfile"):
+        copy_functions.append(
+            lambda src_fd, dst_fd, count:
+                os.sendfile(dst_fd, src_fd, None, count))
+
+    # Some filesystems (e.g., FUSE, overlayfs) spuriously return 0 before
+    # the end of the file, so for regular files we check that we got to
+    # the end, and otherwise continue with the next syscall (the file
+    # positions are updated by both).
+    st = os.fstat(src_fd)
+    if stat.S_ISREG(st.st_mode):
+        expected = max(0, st.st_size - os.lseek(src_fd, 0, os.SEEK_CUR))
+    else:
+        expected = None
+
+    copied = 0
+    for copy_function in copy_functions:
+        try:
+            while True:
+                written = copy_function(src_fd, dst_fd, FASTCOPY_CHUNK_SIZE)
+                if written == 0:
+                    if expected is None or copied >= expected:
+                        return True
+                    break
+                copied += written
+                gevent.sleep(0)
+        except OSError as e:
+            if copied > 0 or e.errno not in _FASTCOPY_UNSUPPORTED_ERRNOS:
+                raise
+    if copied > 0:
+        raise OSError(errno.EIO, "In-kernel copy stopped after %d of %d "
+                      "bytes." % (copied, expected))
+    return False
+
 class Truncator(io.RawIOBase):
     """Wrap a file-like object to simulate truncation.
 
@@ -123,6 +217,17 @@ class Truncator(io.RawIOBase):
         """
         self.fobj = fobj
         self.size = size
+        # Bound once, as it is called for every chunk that is read.
+        self._readinto = fobj.readinto
+        # Number of bytes that can still be read before reaching the
+        # imposed size. We keep it in sync with the position of fobj
+        # ourselves, to avoid querying it at every read.
+        self._remaining = max(0, self.size - self.fobj.tell()) \
+            if self.fobj.seekable() else self.size
+        # The size of the truncated file, computed on the first seek
+        # relative to the end. Files in a sandbox don't grow while we
+        # read them, so it can be cached.
+        self._effective_size = None
 
     def close(self):
         """See io.IOBase.close."""
@@ -146,20 +251,33 @@ class Truncator(io.RawIOBase):
         # This is the main "trick": we clip (i.e. mask, reduce, slice)
         # the given buffer so that it doesn't overflow into the area we
         # want to hide (that is, out of the prefix) and then we forward
-        # it to the wrapped file-like object.
-        b = memoryview(b)[:max(0, self.size - self.fobj.tell())]
-        return self.fobj.readinto(b)
+        # it to the wrapped file-like object. If the buffer already fits
+        # in the prefix we forward it as is.
+        remaining = self._remaining
+        if remaining >= len(b):
+            n = self._readinto(b)
+        else:
+            n = self._readinto(memoryview(b)[:remaining])
+        if n:
+            self._remaining = remaining - n
+        return n
 
     def seek(self, offset, whence=io.SEEK_SET):
         """See io.IOBase.seek."""
         # We have to catch seeks relative to the end of the file and
         # adjust them to the new "imposed" size.
         if whence == io.SEEK_END:
-            if self.fobj.seek(0, io.SEEK_END) > self.size:
-                self.fobj.seek(self.size, io.SEEK_SET)
-            return self.fobj.seek(offset, io.SEEK_CUR)
+            if self._effective_size is None:
+                try:
+                    size = os.fstat(self.fobj.fileno()).st_size
+                except io.UnsupportedOperation:
+                    size = self.fobj.seek(0, io.SEEK_END)
+                self._effective_size = min(self.size, size)
+            pos = self.fobj.seek(self._effective_size + offset, io.SEEK_SET)
         else:
-            return self.fobj.seek(offset, whence)
+            pos = self.fobj.seek(offset, whence)
+        self._remaining = max(0, self.size - pos)
+        return pos
 
     def tell(self):
         """See io.IOBase.tell."""
@@ -169,6 +287,146 @@ class Truncator(io.RawIOBase):
         """See io.RawIOBase.write."""
         raise io.UnsupportedOperation('write')
 
+class MmapReader(io.RawIOBase):
+    """Give read-only access to a prefix of a file through a memory map.
+
+    The prefix is mapped in memory once, and each read is a single copy
+    from the mapping into the caller's buffer, with no call to the
+    underlying file. Being read-only, the file descriptor is not needed
+    after the initialization and can be closed by the caller.
+
+    """
+    def __init__(self, fd, size):
+        """Map the first size bytes of the file open at fd.
+
+        fd (int): a file descriptor open for reading.
+        size (int): the number of bytes that will be accessible; it
+            must not exceed the size of the file.
+
+        """
+        # mmap refuses to map zero bytes, hence the special case.
+        if size > 0:
+            self._mmap = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+            self._view = memoryview(self._mmap)
+        else:
+            self._mmap = None
+            self._view = memoryview(b"")
+        self._pos = 0
+
+    def close(self):
+        """See io.IOBase.close."""
+        if not self.closed:
+            self._view.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        super().close()
+
+    def readable(self):
+        """See io.IOBase.readable."""
+        return True
+
+    def seekable(self):
+        """See io.IOBase.seekable."""
+        return True
+
+    def readinto(self, b):
+        """See io.RawIOBase.readinto."""
+        b = memoryview(b).cast("B")
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def readall(self):
+        """See io.RawIOBase.readall."""
+        data = bytes(self._view[self._pos:])
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """See io.IOBase.seek."""
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        if pos < 0:
+            raise ValueError("negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        """See io.IOBase.tell."""
+        return self._pos
+
+    def write(self, _):
+        """See io.RawIOBase.write."""
+        raise io.UnsupportedOperation('write')
+
+class CgroupHelper:
+    """A cgroup (v2) limiting the memory of the processes it contains.
+
+    The groups are created inside ROOT, which must be an existing cgroup,
+    writable by the user running cpms, with the memory controller enabled
+    for its children.
+
+    """
+    ROOT = "/sys/fs/cgroup/cpms"
+
+    def __init__(self, path):
+        """Wrap an existing group.
+
+        path (str): the path of the group in the cgroup filesystem.
+
+        """
+        self.path = path
+
+    @classmethod
+    def create(cls, name, memory_kib):
+        """Create a group and set its memory limits.
+
+        Above memory_kib, the processes of the group are throttled and
+        their memory reclaimed (memory.high) rather than killed; the
+        hard limit (memory.max) only kicks in a quarter above it.
+
+        name (str): name of the group, unique among the existing ones.
+        memory_kib (int): memory (in KiB) the group can use freely.
+
+        return (CgroupHelper): the new group.
+
+        raise (OSError): if the group cannot be created.
+
+        """
+        helper = cls(os.path.join(cls.ROOT, name))
+        os.mkdir(helper.path)
+        try:
+            helper._write("memory.high", memory_kib * 1024)
+            helper._write("memory.max", memory_kib * 1024 * 5 // 4)
+        except OSError:
+            helper.destroy()
+            raise
+        return helper
+
+    def _write(self, filename, value):
+        """Write an integer to one of the interface files of the group."""
+        with open(os.path.join(self.path, filename), "wt") as f:
+            f.write("%d\n" % value)
+
+    def move(self, pid):
+        """Move a process (and its future children) into the group.
+
+        pid (int): the process to move.
+
+        """
+        self._write("cgroup.procs", pid)
+
+    def destroy(self):
+        """Delete the group, which must not contain any process."""
+        os.rmdir(self.path)
+
 class SandboxInterfaceException(Exception):
     pass
 
@@ -185,6 +443,18 @@ class SandboxBase(metaclass=ABCMeta):
     EXIT_TIMEOUT_WALL = 'wall timeout'
     EXIT_NONZERO_RETURN = 'nonzero return'
 
+    # Maximum number of files create_files_from_storage writes at once.
+    MAX_PARALLEL_FILES = 8
+
+    # Default environment of the sandboxed processes, shared by all the
+    # instances until set_env or inherit_env are accessed. HOME is
+    # specifically needed by Python, that searches the home for packages.
+    DEFAULT_SET_ENV = MappingProxyType({"HOME": "./"})
+    DEFAULT_INHERIT_ENV = ()
+
+    # Used to give unique names to the memory cgroups.
+    _cgroup_ids = itertools.count()
+
     def __init__(self, file_cacher, name=None, temp_dir=None):
         """Initialization.
 
@@ -193,12 +463,17 @@ class SandboxBase(metaclass=ABCMeta):
         name (string|None): name of the sandbox, which might appear in the
             path and in system logs.
         temp_dir (unicode|None): temporary directory to use; if None, use the
-            default temporary directory specified in the configuration.
+            sandbox directory specified in the configuration.
 
         """
         self.file_cacher = file_cacher
         self.name = name if name is not None else "unnamed"
-        self.temp_dir = temp_dir if temp_dir is not None else config.temp_dir
+        self.temp_dir = temp_dir if temp_dir is not None \
+            else config.sandbox_dir
+
+        # get_root_path() with a trailing separator, cached by
+        # relative_path().
+        self._root_prefix = None
 
         self.cmd_file = "commands.log"
 
@@ -209,16 +484,93 @@ class SandboxBase(metaclass=ABCMeta):
         self.cgroup = False
         self.dirs = []
         self.preserve_env = False
-        self.inherit_env = []
-        self.set_env = {}
+        self._inherit_env = None
+        self._set_env = None
         self.verbosity = 0
 
         self.max_processes = 1
 
-        # Set common environment variables.
-        # Specifically needed by Python, that searches the home for
-        # packages.
-        self.set_env["HOME"] = "./"
+        # The processes that we run ourselves, outside of the actual
+        # sandboxing, are confined in a memory cgroup (if available), so
+        # that they can't push the rest of the system out of memory. The
+        # group is created when first needed, and deleted by cleanup().
+        self.memory_cgroup = None
+        self._use_memory_cgroup = config.use_cgroups
+
+    def _move_to_memory_cgroup(self, pid):
+        """Move a process into the memory cgroup of the sandbox.
+
+        The group is created if needed; its limit is the largest memory
+        limit among the runs a sandbox is used for. Processes are moved
+        after they have started, so what they allocated before is
+        charged to our own cgroup. If the group can't be created or
+        used, a warning is logged and the sandbox goes on without it.
+
+        pid (int): the process to move.
+
+        """
+        if not self._use_memory_cgroup:
+            return
+        try:
+            if self.memory_cgroup is None:
+                if not os.path.isdir(CgroupHelper.ROOT):
+                    self._use_memory_cgroup = False
+                    return
+                name = "%s-%d-%d" % (self.name, os.getpid(),
+                                     next(SandboxBase._cgroup_ids))
+                memory_kib = max(config.compilation_sandbox_max_memory_kib,
+                                 config.trusted_sandbox_max_memory_kib)
+                self.memory_cgroup = CgroupHelper.create(name, memory_kib)
+            self.memory_cgroup.move(pid)
+        except ProcessLookupError:
+            # Already terminated.
+            pass
+        except OSError as e:
+            logger.warning("Failed to use memory cgroup for sandbox %s, "
+                           "continuing without it. %s", self.name, e)
+            self._use_memory_cgroup = False
+            self._destroy_memory_cgroup()
+
+    def _destroy_memory_cgroup(self):
+        """Delete the memory cgroup of the sandbox, if any."""
+        if self.memory_cgroup is None:
+            return
+        try:
+            self.memory_cgroup.destroy()
+        except OSError:
+            logger.warning("Failed to delete memory cgroup %s.",
+                           self.memory_cgroup.path, exc_info=True)
+        self.memory_cgroup = None
+
+    @property
+    def inherit_env(self):
+        """Names of the environment variables to inherit ([string]).
+
+        Created from DEFAULT_INHERIT_ENV on first access.
+
+        """
+        if self._inherit_env is None:
+            self._inherit_env = list(self.DEFAULT_INHERIT_ENV)
+        return self._inherit_env
+
+    @inherit_env.setter
+    def inherit_env(self, value):
+        self._inherit_env = value
+
+    @property
+    def set_env(self):
+        """Environment variables to set, with their values ({string: string}).
+
+        Created from DEFAULT_SET_ENV on first access.
+
+        """
+        if self._set_env is None:
+            self._set_env = dict(self.DEFAULT_SET_ENV)
+        return self._set_env
+
+    @set_env.setter
+    def set_env(self, value):
+        self._set_env = value
 
     def set_multiprocess(self, multiprocess):
         """Set the sandbox to (dis-)allow multiple threads and processes.
@@ -240,16 +592,14 @@ class SandboxBase(metaclass=ABCMeta):
 
         """
         execution_time = self.get_execution_time()
-        if execution_time is not None:
-            time_str = "%.3f sec" % (execution_time)
-        else:
-            time_str = "(time unknown)"
         memory_used = self.get_memory_used()
-        if memory_used is not None:
-            mem_str = "%.2f MB" % (memory_used / (1024 * 1024))
-        else:
-            mem_str = "(memory usage unknown)"
-        return "[%s - %s]" % (time_str, mem_str)
+        if execution_time is not None and memory_used is not None:
+            return f"[{execution_time:.3f} sec - {memory_used * _MB:.2f} MB]"
+        time_str = f"{execution_time:.3f} sec" \
+            if execution_time is not None else "(time unknown)"
+        mem_str = f"{memory_used * _MB:.2f} MB" \
+            if memory_used is not None else "(memory usage unknown)"
+        return f"[{time_str} - {mem_str}]"
 
     @abstractmethod
     def get_root_path(self):
@@ -325,7 +675,11 @@ class SandboxBase(metaclass=ABCMeta):
         return (string): the absolute path.
 
         """
-        return os.path.join(self.get_root_path(), path)
+        prefix = self._root_prefix
+        if prefix is None:
+            prefix = self._root_prefix = \
+                self.get_root_path().rstrip(os.sep) + os.sep
+        return join_prefix(prefix, path)
 
     def create_file(self, path, executable=False):
         """Create an empty file in the sandbox and open it in write
@@ -337,23 +691,28 @@ class SandboxBase(metaclass=ABCMeta):
         return (file): the file opened in write binary mode.
 
         """
-        if executable:
-            logger.debug("Creating executable file %s in sandbox.", path)
-        else:
-            logger.debug("Creating plain file %s in sandbox.", path)
+        if logger.isEnabledFor(logging.DEBUG):
+            if executable:
+                logger.debug("Creating executable file %s in sandbox.", path)
+            else:
+                logger.debug("Creating plain file %s in sandbox.", path)
         real_path = self.relative_path(path)
+        mod = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IWUSR
+        if executable:
+            mod |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
         try:
-            file_fd = os.open(real_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            file_fd = os.open(real_path,
+                              os.O_CREAT | os.O_EXCL | os.O_WRONLY
+                              | os.O_NOFOLLOW | os.O_CLOEXEC, mod)
             file_ = open(file_fd, "wb")
         except OSError as e:
             logger.error("Failed create file %s in sandbox. Unable to "
                          "evalulate this submission. This may be due to "
                          "cheating. %s", real_path, e, exc_info=True)
             raise
-        mod = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IWUSR
-        if executable:
-            mod |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
-        os.chmod(real_path, mod)
+        # The umask might have cleared some of the permissions; set them
+        # on the descriptor, which can't be redirected like a path can.
+        os.fchmod(file_fd, mod)
         return file_
 
     def create_file_from_storage(self, path, digest, executable=False):
@@ -365,7 +724,31 @@ class SandboxBase(metaclass=ABCMeta):
 
         """
         with self.create_file(path, executable) as dest_fobj:
-            self.file_cacher.get_file_to_fobj(digest, dest_fobj)
+            with self.file_cacher.get_file(digest) as src_fobj:
+                copied = fastcopy(src_fobj, dest_fobj)
+            if not copied:
+                self.file_cacher.get_file_to_fobj(digest, dest_fobj)
+
+    def create_files_from_storage(self, items):
+        """Write many files taken from FS in the sandbox, concurrently.
+
+        The files are fetched and written by a pool of threads, so that
+        waiting for FS on one of them overlaps with the others.
+
+        items ([(string, string, bool)]): the files to write, each as a
+            tuple of arguments for create_file_from_storage (relative
+            path, digest and, optionally, executable).
+
+        """
+        items = list(items)
+        if len(items) == 0:
+            return
+        pool = ThreadPool(min(self.MAX_PARALLEL_FILES, len(items)))
+        try:
+            pool.map(lambda item: self.create_file_from_storage(*item),
+                     items)
+        finally:
+            pool.kill()
 
     def create_file_from_string(self, path, content, executable=False):
         """Write some data to a file in the sandbox.
@@ -390,29 +773,57 @@ class SandboxBase(metaclass=ABCMeta):
         """
         logger.debug("Retrieving file %s from sandbox.", path)
         real_path = self.relative_path(path)
-        file_ = open(real_path, "rb")
-        if trunc_len is not None:
-            file_ = Truncator(file_, trunc_len)
-        return file_
+        fd = os.open(real_path, os.O_RDONLY | os.O_CLOEXEC)
+        file_ = None
+        try:
+            st = os.fstat(fd)
+            if stat.S_ISDIR(st.st_mode):
+                raise IsADirectoryError(
+                    errno.EISDIR, os.strerror(errno.EISDIR), real_path)
+            regular = stat.S_ISREG(st.st_mode)
+            if trunc_len is None or (regular and trunc_len >= st.st_size):
+                return open(fd, "rb")
+            if not regular:
+                # Devices, FIFOs and the like have no meaningful size
+                # and can't be mapped: stop reading them at trunc_len
+                # instead.
+                file_ = open(fd, "rb")
+                return Truncator(file_, trunc_len)
+        except BaseException:
+            # Once wrapped, the descriptor belongs to the file object.
+            if file_ is not None:
+                file_.close()
+            else:
+                os.close(fd)
+            raise
+        # The mapping keeps the file alive, the descriptor isn't needed.
+        try:
+            return MmapReader(fd, trunc_len)
+        finally:
+            os.close(fd)
 
     def get_file_text(self, path, trunc_len=None):
         """Open a file in the sandbox given its relative path, in text mode.
 
-        Assumes encoding is UTF-8. The caller must handle decoding errors.
+        Assumes encoding is UTF-8. The caller must handle decoding errors,
+        except in a truncated file, where undecodable bytes (like those
+        of a character cut at the end) are replaced with U+FFFD.
 
         path (str): relative path of the file inside the sandbox.
         trunc_len (int|None): if None, does nothing; otherwise, before
-            returning truncate it at the specified length.
+            returning truncate it at the specified length (in bytes).
 
-        return (file): the file opened in read binary mode.
+        return (file): the file opened in read text mode.
 
         """
-        logger.debug("Retrieving text file %s from sandbox.", path)
-        real_path = self.relative_path(path)
-        file_ = open(real_path, "rt", encoding="utf-8")
-        if trunc_len is not None:
-            file_ = Truncator(file_, trunc_len)
-        return file_
+        if trunc_len is None:
+            logger.debug("Retrieving text file %s from sandbox.", path)
+            return open(self.relative_path(path), "rt", encoding="utf-8")
+        # Truncation happens on the bytes, which are then decoded.
+        file_ = self.get_file(path, trunc_len)
+        if isinstance(file_, io.RawIOBase):
+            file_ = io.BufferedReader(file_)
+        return io.TextIOWrapper(file_, encoding="utf-8", errors="replace")
 
     def get_file_to_string(self, path, maxlen=1024):
         """Return the content of a file in the sandbox given its
@@ -425,11 +836,32 @@ class SandboxBase(metaclass=ABCMeta):
         return (string): the content of the file up to maxlen bytes.
 
         """
-        with self.get_file(path) as file_:
-            if maxlen is None:
+        if maxlen is None:
+            with self.get_file(path) as file_:
                 return file_.read()
-            else:
+        # Positional reads are enough, no need for a file object. A
+        # read can return less than asked (e.g., above 0x7ffff000 bytes,
+        # or from a device) without being at EOF, so loop.
+        logger.debug("Retrieving file %s from sandbox.", path)
+        fd = os.open(self.relative_path(path), os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            chunks = []
+            offset = 0
+            while offset < maxlen:
+                chunk = os.pread(fd, maxlen - offset, offset)
+                if len(chunk) == 0:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+            return b"".join(chunks)
+        except OSError as e:
+            # Pipes can only be read sequentially.
+            if e.errno != errno.ESPIPE:
+                raise
+            with open(fd, "rb", closefd=False) as file_:
                 return file_.read(maxlen)
+        finally:
+            os.close(fd)
 
     def get_file_to_storage(self, path, description="", trunc_len=None):
         """Put a sandbox file in FS and return its digest.
@@ -463,7 +895,11 @@ class SandboxBase(metaclass=ABCMeta):
         return (bool): if the file exists.
 
         """
-        return os.path.exists(self.relative_path(path))
+        try:
+            os.stat(self.relative_path(path))
+        except (OSError, ValueError):
+            return False
+        return True
 
     def remove_file(self, path):
         """Delete a file in the sandbox.
@@ -538,6 +974,12 @@ class IsolateSandbox(SandboxBase):
     """
     next_id = 0
 
+    # Path inside the sandbox where its home directory is mounted.
+    HOME_DEST = "/tmp"
+
+    # See SandboxBase.DEFAULT_SET_ENV.
+    DEFAULT_SET_ENV = MappingProxyType({"HOME": HOME_DEST})
+
     # If the command line starts with this command name, we are just
     # going to execute it without sandboxing, and with all permissions
     # on the current directory.
@@ -575,7 +1017,10 @@ class IsolateSandbox(SandboxBase):
         self._outer_dir = tempfile.mkdtemp(dir=self.temp_dir,
                                            prefix="cms-%s-" % (self.name))
         self._home = os.path.join(self._outer_dir, "home")
-        self._home_dest = "/tmp"
+        self._home_dest = self.HOME_DEST
+        # Prefixes for relative_path() and inner_absolute_path().
+        self._home_prefix = self._home + os.sep
+        self._home_dest_prefix = self._home_dest + os.sep
         os.mkdir(self._home)
         self.allow_writing_all()
 
@@ -596,8 +1041,8 @@ class IsolateSandbox(SandboxBase):
         self.chdir = self._home_dest   # -c
         self.dirs = []                 # -d
         self.preserve_env = False      # -e
-        self.inherit_env = []          # -E
-        self.set_env = {}              # -E
+        self._inherit_env = None       # -E
+        self._set_env = None           # -E
         self.fsize = None              # -f
         self.stdin_file = None         # -i
         self.stack_space = None        # -k
@@ -612,11 +1057,6 @@ class IsolateSandbox(SandboxBase):
         self.add_mapped_directory(
             self._home, dest=self._home_dest, options="rw")
 
-        # Set common environment variables.
-        # Specifically needed by Python, that searches the home for
-        # packages.
-        self.set_env["HOME"] = self._home_dest
-
         # Needed on Ubuntu by PHP (and more), since /usr/bin only contains a
         # symlink to one out of many alternatives.
         self.maybe_add_mapped_directory("/etc/alternatives")
@@ -703,8 +1143,11 @@ class IsolateSandbox(SandboxBase):
         # If one of the specified file do not exists, we touch it to
         # assign the correct permissions.
         for path in outer_paths:
-            if not os.path.exists(path):
-                open(path, "wb").close()
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                                 0o666))
+            except FileExistsError:
+                pass
 
         # Close everything, then open only the specified.
         self.allow_writing_none()
@@ -727,7 +1170,7 @@ class IsolateSandbox(SandboxBase):
         return (string): the absolute path.
 
         """
-        return os.path.join(self._home, path)
+        return join_prefix(self._home_prefix, path)
 
     def detect_box_executable(self):
         """Try to find an isolate executable. It first looks in
@@ -747,12 +1190,14 @@ class IsolateSandbox(SandboxBase):
         paths += [self.exec_name]
         for path in paths:
             # Consider only non-directory, executable files with SUID flag on.
-            if os.path.exists(path) \
-                    and not os.path.isdir(path) \
-                    and os.access(path, os.X_OK):
+            try:
                 st = os.stat(path)
-                if st.st_mode & stat.S_ISUID != 0:
-                    return path
+            except OSError:
+                continue
+            if not stat.S_ISDIR(st.st_mode) \
+                    and st.st_mode & stat.S_ISUID != 0 \
+                    and os.access(path, os.X_OK):
+                return path
 
         # As default, return self.exec_name alone, that means that
         # system path is used.
@@ -779,9 +1224,15 @@ class IsolateSandbox(SandboxBase):
             res += ["--dir=%s" % s]
         if self.preserve_env:
             res += ["--full-env"]
-        for var in self.inherit_env:
+        inherit_env = self._inherit_env
+        if inherit_env is None:
+            inherit_env = self.DEFAULT_INHERIT_ENV
+        for var in inherit_env:
             res += ["--env=%s" % var]
-        for var, value in self.set_env.items():
+        set_env = self._set_env
+        if set_env is None:
+            set_env = self.DEFAULT_SET_ENV
+        for var, value in set_env.items():
             res += ["--env=%s=%s" % (var, value)]
         if self.fsize is not None:
             # Isolate wants file size as KiB.
@@ -967,7 +1418,7 @@ class IsolateSandbox(SandboxBase):
         return (string): the absolute path of the file inside the sandbox.
 
         """
-        return os.path.join(self._home_dest, path)
+        return join_prefix(self._home_dest_prefix, path)
 
     def _popen(self, command,
                stdin=None, stdout=None, stderr=None,
@@ -998,12 +1449,15 @@ class IsolateSandbox(SandboxBase):
             try:
                 prev_permissions = stat.S_IMODE(os.stat(self._home).st_mode)
                 os.chmod(self._home, 0o700)
-                with open(self.cmd_file, 'at', encoding="utf-8") as cmds:
-                    cmds.write("%s\n" % (pretty_print_cmdline(command)))
-                p = subprocess.Popen(command, cwd=self._home,
-                                     stdin=stdin, stdout=stdout, stderr=stderr,
-                                     close_fds=close_fds)
-                os.chmod(self._home, prev_permissions)
+                try:
+                    with open(self.cmd_file, 'at', encoding="utf-8") as cmds:
+                        cmds.write("%s\n" % (pretty_print_cmdline(command)))
+                    p = subprocess.Popen(command, cwd=self._home,
+                                         stdin=stdin, stdout=stdout,
+                                         stderr=stderr, close_fds=close_fds)
+                finally:
+                    os.chmod(self._home, prev_permissions)
+                self._move_to_memory_cgroup(p.pid)
                 # For secure commands, we clear the output so that it
                 # is not forwarded to the contestants. Secure commands
                 # are "setup" commands, which should not fail or
@@ -1120,6 +1574,9 @@ class IsolateSandbox(SandboxBase):
         # will be able to delete everything. If not, we leave the files as they
         # are to avoid masking possible problems the admin wanted to debug.
 
+        # The processes we ran outside of isolate are over by now.
+        self._destroy_memory_cgroup()
+
         exe = [self.box_exec] \
             + (["--cg"] if self.cgroup else []) \
             + ["--box-id=%d" % self.box_id]
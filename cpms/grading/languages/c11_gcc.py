@@ -24,18 +24,53 @@
 
 """C programming language definition."""
 
+import functools
+import subprocess
+
 from cpms.grading import CompiledLanguage
 
 
 __all__ = ["C11Gcc"]
 
 
+@functools.lru_cache(maxsize=None)
+def can_use_lld(compiler):
+    """Return whether compiler can link with the LLVM linker, which
+    links much faster than the default one.
+
+    Having ld.lld installed is not enough: gcc accepts -fuse-ld=lld only
+    since version 9, so ask the compiler to run the linker. The answer
+    is cached, the compiler is run at most once.
+
+    compiler (str): the path of the gcc executable.
+
+    return (bool): whether -fuse-ld=lld works with compiler.
+
+    """
+    try:
+        return subprocess.run(
+            [compiler, "-fuse-ld=lld", "-Wl,--version"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, timeout=10).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
 class C11Gcc(CompiledLanguage):
     """This defines the C programming language, compiled with gcc (the
     version available on the system) using the C11 standard.
 
     """
 
+    # Options not depending on the arguments of the compilation.
+    COMPILER = "/usr/bin/gcc"
+    FLAGS = ("-std=gnu11", "-O2", "-pipe")
+    # Executables for evaluation are self-contained and stripped; the
+    # others skip static linking, the slowest step of the compilation,
+    # and are linked with lld when the compiler supports it.
+    EVALUATION_FLAGS = ("-static", "-s")
+    NON_EVALUATION_FLAGS = ("-fno-plt",)
+
     @property
     def name(self):
         """See Language.name."""
@@ -60,11 +95,11 @@ class C11Gcc(CompiledLanguage):
                                  source_filenames, executable_filename,
                                  for_evaluation=True):
         """See Language.get_compilation_commands."""
-        command = ["/usr/bin/gcc"]
         if for_evaluation:
-            command += ["-DEVAL"]
-        command += ["-std=gnu11", "-O2", "-pipe", "-static",
-                    "-s", "-o", executable_filename]
-        command += source_filenames
-        command += ["-lm"]
-        return [command]
+            flags = ("-DEVAL", *self.FLAGS, *self.EVALUATION_FLAGS)
+        else:
+            flags = (*self.FLAGS, *self.NON_EVALUATION_FLAGS)
+            if can_use_lld(self.COMPILER):
+                flags += ("-fuse-ld=lld",)
+        return [[self.COMPILER, *flags, "-o", executable_filename,
+                 *source_filenames, "-lm"]]
@@ -40,6 +40,17 @@ class Python2CPython(CompiledLanguage):
     """
 
     MAIN_FILENAME = "__main__.pyc"
+    INTERPRETER = "/usr/bin/python2"
+    COMPILEALL_COMMAND = (INTERPRETER, "-m", "compileall", ".")
+    # Packages the files given after the archive name without
+    # compression, which .pyc files aren't worth. The zipfile CLI would
+    # deflate them.
+    PACKAGE_COMMAND = (
+        INTERPRETER, "-c",
+        "import sys, zipfile; "
+        "z = zipfile.ZipFile(sys.argv[1], 'w', zipfile.ZIP_STORED); "
+        "[z.write(f) for f in sys.argv[2:]]; "
+        "z.close()")
 
     @property
     def name(self):
@@ -63,7 +74,7 @@ class Python2CPython(CompiledLanguage):
 
         commands = []
         files_to_package = []
-        commands.append(["/usr/bin/python2", "-m", "compileall", "."])
+        commands.append(list(self.COMPILEALL_COMMAND))
         for idx, source_filename in enumerate(source_filenames):
             basename = os.path.splitext(os.path.basename(source_filename))[0]
             pyc_filename = "%s.pyc" % basename
@@ -74,8 +85,10 @@ class Python2CPython(CompiledLanguage):
             else:
                 files_to_package.append(pyc_filename)
 
-        commands.append(["/usr/bin/zip", executable_filename]
-                        + files_to_package)
+        # The zipfile module of the interpreter saves depending on the
+        # zip utility.
+        commands.append(list(self.PACKAGE_COMMAND)
+                        + [executable_filename] + files_to_package)
 
         return commands
 
@@ -83,4 +96,4 @@ class Python2CPython(CompiledLanguage):
             self, executable_filename, main=None, args=None):
         """See Language.get_evaluation_commands."""
         args = args if args is not None else []
-        return [["/usr/bin/python2", executable_filename] + args]
+        return [[self.INTERPRETER, executable_filename] + args]
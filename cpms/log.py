@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+# Contest Practice Management System - https://github.com/BarishNamazov/cpms/
+# Copyright © 2022 Abutalib Barish Namazov <abutalib.namazov@hotmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Logging facilities for cpms.
+
+Nothing is written to file until setup_logging() is called, which
+entry points do explicitly (importing cpms does it only when the
+CPMS_AUTOLOG environment variable is set). By default, records are not
+written to the log file by the thread emitting them: they are put in a
+queue, and a background listener writes them to the file in batches,
+so that logging never blocks the grading code on disk I/O.
+
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+
+from cpms.conf import config
+
+
+LOG_FORMAT = "%(asctime)s.%(msecs)03d %(levelname)s %(module)s - " \
+             "%(funcName)s: %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+# Whether setup_logging() has already been called.
+_logging_set_up = False
+
+
+class BatchingFileHandler(logging.FileHandler):
+    """A FileHandler that doesn't flush the file after each record.
+
+    Records are written to the buffer of the stream, which is flushed
+    periodically by a background thread, or immediately when a record
+    of level flush_level or higher is emitted.
+
+    """
+    def __init__(self, filename, encoding=None, interval=0.1,
+                 flush_level=logging.ERROR):
+        """Initialize the handler and start the flushing thread.
+
+        filename (str): the path of the log file.
+        encoding (str|None): the encoding of the log file.
+        interval (float): maximum time (in seconds) a record stays in
+            the buffer.
+        flush_level (int): records of this level or higher are
+            flushed immediately.
+
+        """
+        super().__init__(filename, encoding=encoding)
+        self.interval = interval
+        self.flush_level = flush_level
+        self._closing = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically,
+                                         name="cpms-log-flusher",
+                                         daemon=True)
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        """Flush the stream every interval seconds until closed."""
+        while not self._closing.wait(self.interval):
+            self.flush()
+
+    def emit(self, record):
+        """See logging.StreamHandler.emit."""
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= self.flush_level:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        """See logging.FileHandler.close."""
+        self._closing.set()
+        self._flusher.join()
+        super().close()
+
+
+def setup_queue_logging(logger, filename, level):
+    """Make logger write to filename through a queue.
+
+    logger (logging.Logger): the logger to configure.
+    filename (str): the path of the log file.
+    level (int): the minimum level of the records to log.
+
+    """
+    file_handler = BatchingFileHandler(filename, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATEFMT))
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, file_handler)
+    listener.start()
+
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(level)
+
+    # Write out what is left in the queue and in the buffer on exit.
+    def stop():
+        listener.stop()
+        file_handler.close()
+    atexit.register(stop)
+
+
+def setup_logging(path="logs.log", level=None, queue=True):
+    """Make the cpms logger write to a file.
+
+    Only the first call has an effect.
+
+    path (str): the path of the log file.
+    level (int|None): the minimum level of the records to log; if None,
+        DEBUG if config.file_log_debug is set, INFO otherwise.
+    queue (bool): whether to write the records from a background thread
+        (see setup_queue_logging) or directly from the emitting one.
+
+    """
+    global _logging_set_up
+    if _logging_set_up:
+        return
+    _logging_set_up = True
+
+    if level is None:
+        level = logging.DEBUG if config.file_log_debug else logging.INFO
+    logger = logging.getLogger("cpms")
+    if queue:
+        setup_queue_logging(logger, path, level)
+    else:
+        file_handler = logging.FileHandler(path, encoding="utf-8")
+        file_handler.setFormatter(
+            logging.Formatter(LOG_FORMAT, LOG_DATEFMT))
+        logger.addHandler(file_handler)
+        logger.setLevel(level)